@@ -27,9 +27,8 @@ class Error(Exception):
 
     def log(self, out):
         """Log the error."""
-        log_f = open(out, 'a')
-        log_f.write(self.message)
-        log_f.close()
+        with open(out, 'a') as log_f:
+            log_f.write(self.message)
 
     pass
 
@@ -3,10 +3,16 @@
 __all__ = ['Fitter', 'dynesty_log_like', 'dynesty_loglike_bma', 'pt_dynesty',
            'pt_multinest']
 
+import os
 import pickle
+import random
 import time
 import warnings
-from multiprocessing import (Pool, set_start_method)
+from collections import namedtuple
+from contextlib import contextmanager, suppress
+from functools import lru_cache, partial
+from multiprocessing import (Pool, Process, set_start_method)
+from uuid import uuid4
 from tqdm import tqdm
 
 import extinction
@@ -43,6 +49,17 @@ except ModuleNotFoundError:
     warnings.warn(
         '(py)MultiNest installation (or libmultinest.dylib) not detected.'
     )
+try:
+    from schwimmbad import MPIPool
+
+    mpi_flag = True
+except ModuleNotFoundError:
+    mpi_flag = False
+
+
+def _using_mpi():
+    """Check if ARIADNE is running under MPI with schwimmbad available."""
+    return mpi_flag and MPIPool.enabled()
 
 if sys.platform == 'darwin':
     set_start_method('spawn', force=True)
@@ -50,6 +67,78 @@ else:
     set_start_method('fork', force=True)
 
 
+# Order of the parameters, not including the noise terms.
+_ORDER_FULL = np.array(['teff', 'logg', 'z', 'dist', 'rad', 'Av'])
+_ORDER_NORM = np.array(['teff', 'logg', 'z', 'norm', 'Av'])
+
+
+# Pickled DataFrame of each model grid.
+_GRID_FILES = {
+    'phoenix': 'Phoenixv2_DF.pkl',
+    'btsettl': 'BTSettl_DF.pkl',
+    'btnextgen': 'BTNextGen_DF.pkl',
+    'btcond': 'BTCond_DF.pkl',
+    'ck04': 'CK04_DF.pkl',
+    'kurucz': 'Kurucz_DF.pkl',
+    'coelho': 'Coelho_DF.pkl',
+}
+
+
+@lru_cache(maxsize=None)
+def _load_interpolator(model):
+    """Load the DFInterpolator of a model grid, only once per process."""
+    with open(f'{gridsdir}/{_GRID_FILES[model]}', 'rb') as intp:
+        return DFInterpolator(pd.read_pickle(intp))
+
+
+@lru_cache(maxsize=4)
+def _load_ppf(path):
+    """Load a tabulated ppf saved as a (2, N) array of quantiles and values."""
+    u, x = np.load(path)
+    return TabulatedPPF(u, x)
+
+
+FitState = namedtuple('FitState', [
+    'flux', 'flux_er', 'filts', 'ext', 'coordinator', 'fixed', 'use_norm',
+    'prior_ppfs', 'band_grid'
+])
+FitState.__doc__ = """Frozen inputs of the likelihood and prior transform wrappers.
+
+The state reaches the wrappers through the sampler's logl_args and
+ptform_args and pickles by value, so it works with any pool.
+"""
+
+# States of the multiprocessing pools that are currently open, by pool key.
+# In a worker the pool initializer stores its pool's state here.
+_POOL_STATES = dict()
+
+
+def _get_pool_state(key):
+    """Return the state of the pool with the given key."""
+    return _POOL_STATES[key]
+
+
+class _PoolState(FitState):
+    """FitState handed to the workers of a multiprocessing Pool.
+
+    Dynesty pickles logl_args and ptform_args with every task it sends to
+    the pool, and the band grid alone is a few hundred kB. The workers
+    already got the state from the pool initializer, so while the pool is
+    open this pickles as the pool key only. Otherwise (e.g. when the sampler
+    itself is pickled after the fit) it pickles by value as a FitState.
+    """
+
+    def __new__(cls, key, state):
+        self = super().__new__(cls, *state)
+        self.key = key
+        return self
+
+    def __reduce__(self):
+        if self.key in _POOL_STATES:
+            return _get_pool_state, (self.key,)
+        return FitState, tuple(self)
+
+
 class Fitter:
     """The Fitter class handles the fitting routines and parameter estimation.
 
@@ -90,6 +179,8 @@ class Fitter:
         Description of attribute `prior_setup`.
     sequential : type
         Description of attribute `sequential`.
+    bma_dlogz : bool
+        Relax dlogz with the number of models in BMA.
 
     """
 
@@ -113,6 +204,8 @@ class Fitter:
         self.prior_setup = None
         self.sequential = True
         self.experimental = False
+        self.bma_dlogz = False
+        self._mpi_pool = None
 
     @property
     def star(self):
@@ -187,27 +280,8 @@ class Fitter:
     def grid(self, grid):
         assert type(grid) == str
         self._grid = grid
-        if grid.lower() == 'phoenix':
-            with open(gridsdir + '/Phoenixv2_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
-        if grid.lower() == 'btsettl':
-            with open(gridsdir + '/BTSettl_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
-        if grid.lower() == 'btnextgen':
-            with open(gridsdir + '/BTNextGen_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
-        if grid.lower() == 'btcond':
-            with open(gridsdir + '/BTCond_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
-        if grid.lower() == 'ck04':
-            with open(gridsdir + '/CK04_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
-        if grid.lower() == 'kurucz':
-            with open(gridsdir + '/Kurucz_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
-        if grid.lower() == 'coelho':
-            with open(gridsdir + '/Coelho_DF.pkl', 'rb') as intp:
-                self._interpolator = DFInterpolator(pd.read_pickle(intp))
+        if grid.lower() in _GRID_FILES:
+            self._interpolator = self.load_interpolator(grid)
 
     @property
     def bma(self):
@@ -240,6 +314,15 @@ class Fitter:
     def sequential(self, sequential):
         self._sequential = sequential
 
+    @property
+    def bma_dlogz(self):
+        """Set to True to relax dlogz with the number of models in BMA."""
+        return self._bma_dlogz
+
+    @bma_dlogz.setter
+    def bma_dlogz(self, bma_dlogz):
+        self._bma_dlogz = bma_dlogz
+
     @property
     def n_samples(self):
         """Set number of samples for BMA."""
@@ -310,34 +393,18 @@ class Fitter:
 
         To be run only after every input is added.
         This function calculates the number of dimensions, runs the prior
-        creation, creates output directory, initializes coordinators and sets
-        up global variables.
+        creation, creates output directory, initializes coordinators and
+        tabulates the prior ppfs.
         """
-        global prior_dict, coordinator, fixed, order, star, use_norm, av_law
         self.start = time.time()
         err_msg = 'No star is detected. Please create an instance of Star.'
         if self.star is None:
             er = InputError(err_msg)
             er.log(self.out + '/output.log')
             er.__raise__()
-        star = self.star
-        if not self._bma:
-            global interpolator
-            interpolator = self._interpolator
-        use_norm = self.norm
-        # Extinction law
-        av_law = self._av_law
 
         # Declare order of parameters.
-        if not self.norm:
-            order = np.array(
-                [
-                    'teff', 'logg', 'z',
-                    'dist', 'rad', 'Av'
-                ]
-            )
-        else:
-            order = np.array(['teff', 'logg', 'z', 'norm', 'Av'])
+        self._order = _ORDER_NORM if self.norm else _ORDER_FULL
 
         # Create output directory
         if self.out_folder is None:
@@ -354,19 +421,25 @@ class Fitter:
         npars = 6 if not self.norm else 5
         npars += self.star.used_filters.sum()
         npars = int(npars)
-        self.coordinator = np.zeros(npars)  # 1 for fixed params
+        self.coordinator = np.zeros(npars, dtype=np.int8)  # 1 for fixed
         self.fixed = np.zeros(npars)
-        coordinator = self.coordinator
-        fixed = self.fixed
 
         # Setup priors.
         self.default_priors = self._default_priors()
+        # The order is complete once the noise terms are in.
+        self._param_to_idx = {p: i for i, p in enumerate(self._order)}
         self.create_priors_from_setup()
-        prior_dict = self.priors
 
         # Get dimensions.
         self.ndim = self.get_ndim()
 
+        # Indices of the free parameters, used when saving the results.
+        self._free_idxs = np.flatnonzero(self.coordinator == 0)
+
+        # Tabulate the ppf of each free parameter for the prior transforms.
+        self._prior_ppfs = [tabulate_ppf(self.priors[par])
+                            for par in self._order[self._free_idxs]]
+
         # warnings
         if len(self._setup) == 1:
             print('USING DEFAULT SETUP VALUES.')
@@ -403,6 +476,14 @@ class Fitter:
                 self._grids.append(mod)
             thr = self._threads if self._sequential else len(
                 self._interpolators)
+            # The model evidences are averaged, so if asked to each one can
+            # be less precise the more models there are, up to dlogz = 1.
+            bma_dlogz = min(0.25 * len(self._grids), 1.)
+            if self.bma_dlogz and bma_dlogz > self._dlogz:
+                dlogz_msg = f'Relaxing dlogz from {self._dlogz} to '
+                dlogz_msg += f'{bma_dlogz} for {len(self._grids)} models.'
+                print(colored(dlogz_msg, 'yellow'))
+                self._dlogz = bma_dlogz
         else:
             thr = self._threads
         en = 'Bayesian Model Averaging' if self._bma else self._engine
@@ -417,7 +498,6 @@ class Fitter:
         return int(ndim)
 
     def _default_priors(self):
-        global order
         defaults = dict()
         # Logg prior setup.
         if self.star.get_logg:
@@ -428,8 +508,7 @@ class Fitter:
             #     defaults['logg'] = pickle.load(jar)
             defaults['logg'] = st.uniform(loc=3.5, scale=2.5)
         # Teff prior from RAVE
-        with open(priorsdir + '/teff_ppf.pkl', 'rb') as jar:
-            defaults['teff'] = pickle.load(jar)
+        defaults['teff'] = _load_ppf(priorsdir + '/teff_ppf.npy')
         # [Fe/H] prior setup.
         defaults['z'] = st.norm(loc=-0.125, scale=0.234)
         # Distance prior setup.
@@ -467,6 +546,7 @@ class Fitter:
         mask = self.star.filter_mask
         flxs = self.star.flux[mask]
         errs = self.star.flux_er[mask]
+        noise = []
         for filt, flx, flx_e in zip(self.star.filter_names[mask], flxs, errs):
             p_ = get_noise_name(filt) + '_noise'
             mu = 0
@@ -474,7 +554,8 @@ class Fitter:
             b = (1 - flx) / flx_e
             defaults[p_] = st.truncnorm(loc=mu, scale=sigma, a=0, b=b)
             # defaults[p_] = st.uniform(loc=0, scale=5)
-            order = np.append(order, p_)
+            noise.append(p_)
+        self._order = np.concatenate((self._order, noise))
         return defaults
 
     def create_priors_from_setup(self):
@@ -504,15 +585,14 @@ class Fitter:
                     if k == 'logg' or k == 'teff':
                         if k == 'teff':
                             PriorError('teff', 2).warn()
-                        with open(priorsdir + '/teff_ppf.pkl', 'rb') as jar:
-                            prior_dict[k] = pickle.load(jar)
+                        prior_dict[k] = _load_ppf(priorsdir + '/teff_ppf.npy')
                         prior_out += k + '\tRAVE\n'
 
             else:
                 prior = self.prior_setup[k][0]
                 if prior == 'fixed':
                     value = self.prior_setup[k][1]
-                    idx = np.where(k == order)[0]
+                    idx = self._param_to_idx[k]
                     self.coordinator[idx] = 1
                     self.fixed[idx] = value
                     prior_out += k + '\tfixed\t{}\n'.format(value)
@@ -538,19 +618,20 @@ class Fitter:
                     prior_out += k + '\tuniform\t{}\t{}\n'.format(low, up)
         for par in noise:
             prior_dict[par] = self.default_priors[par]
-        ff = open(self.out_folder + '/prior.dat', 'w')
-        ff.write(prior_out)
-        ff.close()
-        del ff
+        with open(self.out_folder + '/prior.dat', 'w') as ff:
+            ff.write(prior_out)
         self.priors = prior_dict
         pass
 
     def fit(self):
         """Run fitting routine."""
-        if self._engine == 'multinest':
-            self.fit_multinest()
-        else:
-            self.fit_dynesty()
+        try:
+            if self._engine == 'multinest':
+                self.fit_multinest()
+            else:
+                self.fit_dynesty()
+        finally:
+            self._close_mpi_pool()
         elapsed_time = execution_time(self.start)
         end(self.coordinator, elapsed_time,
             self.out_folder, self._engine, self.norm, )
@@ -559,25 +640,48 @@ class Fitter:
     def fit_bma(self):
         """Perform the fit with different models and the average the output.
 
-        Only works with dynesty.
+        Only works with dynesty. Under MPI the models are always fit one
+        after the other, all of them sharing the same MPIPool.
         """
         if len(self.star.filter_names[self.star.filter_mask]) <= 5:
             print(colored('\t\t\tNOT ENOUGH POINTS TO MAKE THE FIT! !', 'red'))
             return
 
-        global interpolator
-        for intp, gr in zip(self._interpolators, self._grids):
-            interpolator = intp
-            self.grid = gr
-            out_file = self.out_folder + '/' + gr + '_out.pkl'
-            print('\t\t\tFITTING MODEL : ' + gr)
+        # Outputs of an earlier run can't stand in for a failed fit. Under
+        # MPI every rank gets here, so another one may have removed them.
+        for gr in self._grids:
+            with suppress(FileNotFoundError):
+                os.remove(f'{self.out_folder}/{gr}_out.pkl')
+
+        if self._sequential or _using_mpi():
             try:
-                self.fit_dynesty(out_file=out_file)
-            except ValueError as e:
-                dump_out = self.out_folder + '/' + gr + '_DUMP.pkl'
-                pickle.dump(self.sampler.results, open(dump_out, 'wb'))
-                DynestyError(dump_out, gr, e).__raise__()
-                continue
+                for intp, gr in zip(self._interpolators, self._grids):
+                    self._fit_model(intp, gr)
+            finally:
+                self._close_mpi_pool()
+        else:
+            # Each model is fit in its own process, splitting the threads
+            # between them. The outputs are read back from disk below.
+            threads = max(1, self._threads // len(self._grids))
+            procs = []
+            for intp, gr in zip(self._interpolators, self._grids):
+                p = Process(target=self._fit_model, args=(intp, gr, threads))
+                p.start()
+                procs.append(p)
+            for p in procs:
+                p.join()
+            # DynestyError exits the child with status 0 after reporting
+            # the error, so a missing output also means the fit failed.
+            failed = False
+            for p, gr in zip(procs, self._grids):
+                if p.exitcode != 0 or \
+                        not os.path.exists(f'{self.out_folder}/{gr}_out.pkl'):
+                    fail_msg = f'\t\t\tFIT FOR MODEL {gr} FAILED! '
+                    fail_msg += f'(EXIT CODE {p.exitcode})'
+                    print(colored(fail_msg, 'red'))
+                    failed = True
+            if failed:
+                sys.exit(1)
 
         # Now that the fitting finished, read the outputs and average
         # the posteriors
@@ -587,7 +691,7 @@ class Fitter:
             outs.append(in_folder)
             # with open(in_folder, 'rb') as out:
             #     outs.append(pickle.load(out))
-        c = np.random.choice(self.colors)
+        c = random.choice(self.colors)
         avgd = self.bayesian_model_average(outs, self._grids, self._norm,
                                            self.n_samples, c)
         self.save_bma(avgd)
@@ -597,37 +701,57 @@ class Fitter:
             'Bayesian Model Averaging', self.norm)
         pass
 
+    def _fit_model(self, intp, grid, threads=None):
+        """Fit a single model grid of the BMA."""
+        if threads is not None:
+            self._threads = threads
+        self.grid = grid
+        self._interpolator = intp
+        out_file = self.out_folder + '/' + grid + '_out.pkl'
+        print('\t\t\tFITTING MODEL : ' + grid)
+        try:
+            self.fit_dynesty(out_file=out_file)
+        except ValueError as e:
+            dump_out = self.out_folder + '/' + grid + '_DUMP.pkl'
+            with open(dump_out, 'wb') as jar:
+                pickle.dump(self.sampler.results, jar,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            DynestyError(dump_out, grid, e).__raise__()
+
     def _bma_dynesty(self, intp, grid):
-        global interpolator
-        interpolator = intp
+        self.grid = grid
+        self._interpolator = intp
+        state = self._build_state()
 
         # Parallel parallelized routine experiment
         if self.experimental:
             if self._dynamic:
-                with Pool(self._threads) as executor:
+                with self._make_pool(state) as (executor, pool_state):
                     sampler = dynesty.DynamicNestedSampler(
                         dynesty_loglike_bma, pt_dynesty, self.ndim,
                         bound=self._bound, sample=self._sample, pool=executor,
-                        queue_size=self._threads, logl_args=([intp])
+                        queue_size=self._queue_size(), logl_args=(pool_state,),
+                        ptform_args=(pool_state,)
                     )
                     sampler.run_nested(dlogz_init=self._dlogz,
                                        nlive_batch=self._nlive,
                                        wt_kwargs={'pfrac': .95})
             else:
-                with Pool(self._threads) as executor:
+                with self._make_pool(state) as (executor, pool_state):
                     sampler = dynesty.NestedSampler(
                         dynesty_loglike_bma, pt_dynesty, self.ndim,
                         nlive=self._nlive, bound=self._bound,
                         sample=self._sample, pool=executor,
-                        queue_size=self._threads, logl_args=([intp])
+                        queue_size=self._queue_size(), logl_args=(pool_state,),
+                        ptform_args=(pool_state,)
                     )
                     sampler.run_nested(dlogz=self._dlogz)
 
         elif self._dynamic:
             sampler = dynesty.DynamicNestedSampler(
                 dynesty_loglike_bma, pt_dynesty, self.ndim,
-                bound=self._bound, sample=self._sample, logl_args=([intp])
-
+                bound=self._bound, sample=self._sample, logl_args=(state,),
+                ptform_args=(state,)
             )
             sampler.run_nested(dlogz_init=self._dlogz,
                                nlive_init=self._nlive,
@@ -638,12 +762,14 @@ class Fitter:
                     dynesty_loglike_bma, pt_dynesty, self.ndim,
                     nlive=self._nlive, bound=self._bound,
                     sample=self._sample,
-                    logl_args=([intp])
+                    logl_args=(state,), ptform_args=(state,)
                 )
                 self.sampler.run_nested(dlogz=self._dlogz)
             except Error:
                 dump_out = self.out_folder + '/' + grid + '_DUMP.pkl'
-                pickle.dump(self.sampler.results, open(dump_out, 'wb'))
+                with open(dump_out, 'wb') as jar:
+                    pickle.dump(self.sampler.results, jar,
+                                protocol=pickle.HIGHEST_PROTOCOL)
                 er = DynestyError(dump_out, grid)
                 er.log(self.out + '/output.log')
                 er.__raise__()
@@ -655,17 +781,13 @@ class Fitter:
 
     def fit_multinest(self, out_file=None):
         """Run MultiNest."""
-        # Set up some globals
-        global mask, flux, flux_er, filts, wave
-        mask = star.filter_mask
-        flux = star.flux[mask]
-        flux_er = star.flux_er[mask]
-        filts = star.filter_names[mask]
-        wave = star.wave[mask]
+        # MultiNest has no way to pass extra arguments to the callbacks.
+        state = self._build_state()
         path = self.out_folder + '/mnest/'
         create_dir(path)  # Create multinest path.
         pymultinest.run(
-            multinest_log_like, pt_multinest, self.ndim,
+            partial(multinest_log_like, state=state),
+            partial(pt_multinest, state=state), self.ndim,
             n_params=self.ndim,
             sampling_efficiency=0.8,
             evidence_tolerance=self._dlogz,
@@ -681,22 +803,21 @@ class Fitter:
         pass
 
     def fit_dynesty(self, out_file=None):
-        """Run dynesty."""
-        # Set up some globals
-        global mask, flux, flux_er, filts, wave
-        mask = star.filter_mask
-        flux = star.flux[mask]
-        flux_er = star.flux_er[mask]
-        filts = star.filter_names[mask]
-        wave = star.wave[mask]
+        """Run dynesty.
+
+        Under MPI the pool is always used, whatever the number of threads,
+        so the worker ranks don't each run the whole fit on their own.
+        """
+        state = self._build_state()
         if self._dynamic:
-            if self._threads > 1:
-                with Pool(self._threads) as executor:
+            if self._threads > 1 or _using_mpi():
+                with self._make_pool(state) as (executor, pool_state):
                     self.sampler = dynesty.DynamicNestedSampler(
                         dynesty_log_like, pt_dynesty, self.ndim,
+                        logl_args=(pool_state,), ptform_args=(pool_state,),
                         bound=self._bound, sample=self._sample,
                         pool=executor, walks=25,
-                        queue_size=self._threads - 1
+                        queue_size=self._queue_size()
                     )
                     self.sampler.run_nested(dlogz_init=self._dlogz,
                                             nlive_init=self._nlive,
@@ -704,26 +825,28 @@ class Fitter:
             else:
                 self.sampler = dynesty.DynamicNestedSampler(
                     dynesty_log_like, pt_dynesty, self.ndim, walks=25,
+                    logl_args=(state,), ptform_args=(state,),
                     bound=self._bound, sample=self._sample
-
                 )
                 self.sampler.run_nested(dlogz_init=self._dlogz,
                                         nlive_init=self._nlive,
                                         wt_kwargs={'pfrac': 1})
         else:
-            if self._threads > 1:
-                with Pool(self._threads) as executor:
+            if self._threads > 1 or _using_mpi():
+                with self._make_pool(state) as (executor, pool_state):
                     self.sampler = dynesty.NestedSampler(
                         dynesty_log_like, pt_dynesty, self.ndim,
+                        logl_args=(pool_state,), ptform_args=(pool_state,),
                         nlive=self._nlive, bound=self._bound,
                         sample=self._sample,
                         pool=executor, walks=25,
-                        queue_size=self._threads - 1,
+                        queue_size=self._queue_size(),
                     )
                     self.sampler.run_nested(dlogz=self._dlogz)
             else:
                 self.sampler = dynesty.NestedSampler(
                     dynesty_log_like, pt_dynesty, self.ndim, walks=25,
+                    logl_args=(state,), ptform_args=(state,),
                     nlive=self._nlive, bound=self._bound,
                     sample=self._sample
                 )
@@ -734,6 +857,80 @@ class Fitter:
         self.save(out_file, results=results)
         pass
 
+    def _build_state(self):
+        """Set up the state of the likelihood and prior transform wrappers."""
+        mask = self.star.filter_mask
+        filts = self.star.filter_names[mask]
+        ext = unit_extinction(self.star.wave[mask], self._av_law)
+        self._state = FitState(
+            self.star.flux[mask], self.star.flux_er[mask], filts, ext,
+            self.coordinator, self.fixed, self.norm, self._prior_ppfs,
+            BandGrid(self._interpolator, filts)
+        )
+        return self._state
+
+    @contextmanager
+    def _make_pool(self, state):
+        """Create the pool of workers used by dynesty.
+
+        If ARIADNE is running under MPI (and schwimmbad is installed) an
+        MPIPool is used, otherwise a multiprocessing Pool. Either way the
+        workers get the sampler state once, before the sampler starts. On
+        exit the workers of a multiprocessing Pool are always joined, and
+        terminated first if the sampler raised.
+
+        Yields the pool and the state to give to the sampler.
+        """
+        key = uuid4().hex
+        pool_state = _PoolState(key, state)
+        if _using_mpi():
+            # A single MPIPool serves every fit of the Fitter, the worker
+            # ranks stay in wait() until it's closed by _close_mpi_pool at
+            # the end of fit or fit_bma, and then exit.
+            if self._mpi_pool is None:
+                self._mpi_pool = MPIPool()
+                if not self._mpi_pool.is_master():
+                    self._mpi_pool.wait()
+                    sys.exit(0)
+            pool = self._mpi_pool
+            # Every rank gets the state once, then only its key.
+            _run_on_mpi_workers(pool, partial(_init_worker, key), tuple(state))
+            _POOL_STATES[key] = pool_state
+            try:
+                yield pool, pool_state
+            finally:
+                del _POOL_STATES[key]
+            # If the sampler raised the workers may still be busy, and the
+            # pool gets closed right away anyway.
+            _run_on_mpi_workers(pool, _drop_worker_state, key)
+            return
+        _POOL_STATES[key] = pool_state
+        # A plain tuple so the state itself, not its key, gets to the workers.
+        pool = Pool(self._threads, initializer=_init_worker,
+                    initargs=(key, tuple(state)))
+        try:
+            yield pool, pool_state
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            del _POOL_STATES[key]
+
+    def _queue_size(self):
+        """Number of points dynesty evaluates in parallel."""
+        if self._mpi_pool is not None:
+            return self._mpi_pool.size
+        return self._threads
+
+    def _close_mpi_pool(self):
+        """Close the MPIPool, if any, which lets the worker ranks exit."""
+        if self._mpi_pool is not None:
+            self._mpi_pool.close()
+            self._mpi_pool = None
+
     def save(self, out_file, results=None):
         """Save multinest/dynesty output and relevant information.
 
@@ -742,10 +939,9 @@ class Fitter:
 
         lnZ: The global evidence.
         lnZerr: The global evidence error.
-        posterior_samples: A dictionary containing the samples of each
-                            parameter (even if it's fixed), the evidence,
-                            log likelihood, the prior, and the posterior
-                            for each set of sampled parameters.
+        posterior_samples: A structured array with a column for the samples
+                            of each parameter (even if it's fixed), each
+                            derived parameter and the log likelihood.
         fixed: An array with the fixed parameter values.
         coordinator : An array with the status of each parameter (1 for fixed
                       0 for free)
@@ -779,36 +975,38 @@ class Fitter:
         out['global_lnZ'] = lnz
         out['global_lnZerr'] = lnzer
 
-        # Create raw samples holder
-
-        out['posterior_samples'] = dict()
-        j = 0
-        k = 0  # filter counter
-        for i, param in enumerate(order):
-            if not self.coordinator[i]:
-                samples = posterior_samples[:, j]
-                if 'noise' in param:
-                    filt = self.star.filter_names[mask][k]
-                    flx = self.star.flux[mask][k]
-                    _, samples = flux_to_mag(flx, samples, filt)
-                    k += 1
-                out['posterior_samples'][param] = samples
-                j += 1
-            else:
-                out['posterior_samples'][param] = self.fixed[i]
-
-        # Save loglike, priors and posteriors.
+        # Create raw samples holder. It's a structured array with a column
+        # for each parameter, derived parameter and the log likelihood.
 
-        out['posterior_samples']['loglike'] = np.zeros(
-            posterior_samples.shape[0]
+        derived = ['grav_mass', 'lum']
+        if self.norm and self.star.dist != -1:
+            derived.insert(0, 'rad')
+        if not self.norm:
+            derived.append('AD')
+        names = [str(p) for p in self._order] + derived + ['loglike']
+        out['posterior_samples'] = np.empty(
+            posterior_samples.shape[0], dtype=[(p, 'f8') for p in names]
         )
+        for i in np.flatnonzero(self.coordinator):
+            out['posterior_samples'][self._order[i]] = self.fixed[i]
+        filts_used = self.star.filter_names[mask]
+        flux_used = self.star.flux[mask]
+        n_base = 5 if self.norm else 6  # Noise terms come after these.
+        for j, i in enumerate(self._free_idxs):
+            param = self._order[i]
+            samples = posterior_samples[:, j]
+            if 'noise' in param:
+                k = i - n_base  # filter index
+                _, samples = flux_to_mag(flux_used[k], samples, filts_used[k])
+            out['posterior_samples'][param] = samples
 
         # If normalization constant was fitted, create a distribution of radii
         # only if there's a distance available.
 
-        if use_norm and star.dist != -1:
+        if self.norm and self.star.dist != -1:
             rad = self._get_rad(
-                out['posterior_samples']['norm'], star.dist, star.dist_e
+                out['posterior_samples']['norm'], self.star.dist,
+                self.star.dist_e
             )
             out['posterior_samples']['rad'] = rad
 
@@ -827,18 +1025,21 @@ class Fitter:
 
         # Create a distribution of angular diameters.
 
-        if not use_norm:
+        if not self.norm:
             dist_samp = out['posterior_samples']['dist']
             ad_samp = self._get_angular_diameter(rad_samp, dist_samp)
             out['posterior_samples']['AD'] = ad_samp
 
-        for i in range(posterior_samples.shape[0]):
-            theta = build_params(
-                posterior_samples[i, :], flux, flux_er, filts, coordinator,
-                fixed, self.norm)
-            out['posterior_samples']['loglike'][i] = log_likelihood(
-                theta, flux, flux_er, wave, filts, interpolator, self.norm,
-                av_law)
+        # Save loglike. A single vectorized call takes tens of ms even for
+        # ~1e5 samples, less than shipping the samples to a pool would.
+
+        wave = self.star.wave[mask]
+        thetas = build_params_batch(posterior_samples, self.coordinator,
+                                    self.fixed)
+        out['posterior_samples']['loglike'] = log_likelihood_batch(
+            thetas, self._state.flux, self._state.flux_er, wave,
+            self._state.filts, self._state.band_grid, self.norm,
+            self._av_law)
 
         # Best fit
         # The logic is as follows:
@@ -851,9 +1052,11 @@ class Fitter:
             out['best_fit'] = dict()
             out['uncertainties'] = dict()
             out['confidence_interval'] = dict()
-            best_theta = np.zeros(order.shape[0])
+            # Fixed parameters are already in place. Free noise terms are
+            # left at 0.
+            best_theta = np.where(self.coordinator == 1, self.fixed, 0.)
 
-            for i, param in enumerate(order):
+            for i, param in enumerate(self._order):
                 if not self.coordinator[i]:
                     if 'noise' in param:
                         continue
@@ -864,18 +1067,18 @@ class Fitter:
                     elif param == 'norm':
                         logdat = out_filler(samp, logdat, param, '(R/D)^2',
                                             out, fmt='e')
-                        if star.dist != 1:
+                        if self.star.dist != 1:
                             logdat = out_filler(
                                 out['posterior_samples']['rad'], logdat, 'rad',
                                 'R', out
                             )
                     else:
                         logdat = out_filler(samp, logdat, param, param, out)
+                    best_theta[i] = out['best_fit'][param]
                 else:
                     logdat = out_filler(
-                        0, logdat, param, out, fixed=self.fixed[i]
+                        0, logdat, param, param, out, fixed=self.fixed[i]
                     )
-                best_theta[i] = out['best_fit'][param]
 
             # Add derived mass to best fit dictionary.
 
@@ -891,23 +1094,22 @@ class Fitter:
 
             # Add derived angular diameter to best fit dictionary.
 
-            if not use_norm:
+            if not self.norm:
                 samp = out['posterior_samples']['AD']
                 logdat = out_filler(samp, logdat, 'AD', 'AD', out)
 
-            for i, param in enumerate(order):
-                if not self.coordinator[i]:
-                    if 'noise' not in param:
-                        continue
-                    samp = out['posterior_samples'][param]
-                    logdat = out_filler(samp, logdat, param,
-                                        param, out, fmt='f')
+            for param in self._order[self._free_idxs]:
+                if 'noise' not in param:
+                    continue
+                samp = out['posterior_samples'][param]
+                logdat = out_filler(samp, logdat, param, param, out, fmt='f')
 
             # Fill in best loglike, prior and posterior.
 
             out['best_fit']['loglike'] = log_likelihood(
-                best_theta, flux, flux_er, wave,
-                filts, interpolator, self.norm, av_law
+                best_theta, self._state.flux, self._state.flux_er, wave,
+                self._state.filts, self._state.band_grid, self.norm,
+                self._av_law
             )
 
             # Spectral type
@@ -926,15 +1128,17 @@ class Fitter:
 
         out['fixed'] = self.fixed
         out['coordinator'] = self.coordinator
+        out['order'] = self._order
         out['star'] = self.star
         out['engine'] = self._engine
         out['norm'] = self.norm
         out['model_grid'] = self.grid
-        out['av_law'] = av_law
+        out['av_law'] = self._av_law
         if not self.bma:
             with open(log_out, 'w') as logfile:
                 logfile.write(logdat)
-        pickle.dump(out, open(out_file, 'wb'))
+        with open(out_file, 'wb') as jar:
+            pickle.dump(out, jar, protocol=pickle.HIGHEST_PROTOCOL)
         pass
 
     def save_bma(self, avgd):
@@ -981,7 +1185,7 @@ class Fitter:
         out['weighted_samples'] = dict()
         out['weighted_average'] = dict()
         j = 0
-        for i, par in enumerate(order):
+        for i, par in enumerate(self._order):
             if not self.coordinator[i]:
                 out['weighted_samples'][par] = avgd['weighted_samples'][par]
                 out['weighted_average'][par] = avgd['weighted_average'][par]
@@ -992,12 +1196,14 @@ class Fitter:
 
         # If normalization constant was fitted, create a distribution of radii.
 
-        if use_norm and star.dist != -1:
+        if self.norm and self.star.dist != -1:
             rad_sampled = self._get_rad(
-                out['weighted_samples']['norm'], star.dist, star.dist_e
+                out['weighted_samples']['norm'], self.star.dist,
+                self.star.dist_e
             )
             rad_averageed = self._get_rad(
-                out['weighted_average']['norm'], star.dist, star.dist_e
+                out['weighted_average']['norm'], self.star.dist,
+                self.star.dist_e
             )
             out['weighted_samples']['rad'] = rad_sampled
             out['weighted_average']['rad'] = rad_averageed
@@ -1024,7 +1230,7 @@ class Fitter:
 
         # Create a distribution of angular diameters.
 
-        if not use_norm:
+        if not self.norm:
             dist_samp = out['weighted_samples']['dist']
             dist_average = out['weighted_average']['dist']
             ad_samp = self._get_angular_diameter(rad_samp, dist_samp)
@@ -1044,7 +1250,7 @@ class Fitter:
         out['best_fit_averaged'] = dict()
         out['uncertainties_averaged'] = dict()
         out['confidence_interval_averaged'] = dict()
-        for i, param in enumerate(order):
+        for i, param in enumerate(self._order):
             if not self.coordinator[i]:
                 if 'noise' in param:
                     continue
@@ -1064,7 +1270,7 @@ class Fitter:
                     logdat_average = out_filler(sampw, logdat_average, param,
                                                 '(R/D)^2', out, fmt='e',
                                                 method='averaged')
-                    if star.dist != 1:
+                    if self.star.dist != 1:
                         logdat_samples = out_filler(
                             out['weighted_samples']['rad'], logdat_samples,
                             'rad', 'R', out, method='samples'
@@ -1109,7 +1315,7 @@ class Fitter:
 
         # Add derived angular diameter to best fit dictionary.
 
-        if not use_norm:
+        if not self.norm:
             samp = out['weighted_samples']['AD']
             sampw = out['weighted_average']['AD']
             logdat_samples = out_filler(samp, logdat_samples, 'AD', 'AD', out,
@@ -1123,7 +1329,7 @@ class Fitter:
         age_samp, mass_samp, eep_samp = self.estimate_age(
             out['best_fit_samples'],
             out['uncertainties_samples'],
-            c=choice(self.colors)
+            c=random.choice(self.colors)
         )
         # Create new thingy for MIST samples. Sadly now everything done before
         # this update will be incompatible :(
@@ -1182,18 +1388,15 @@ class Fitter:
         ogteff = avgd['originals'][max_prob_mod]['teff']
         oglogg = avgd['originals'][max_prob_mod]['logg']
         ogfeh = avgd['originals'][max_prob_mod]['z']
-        fluxes = np.zeros((len(oglogg), len(filter_names)))
-        for i, t, g, z in zip(range(len(oglogg)), ogteff, oglogg, ogfeh):
-            fluxes[i, :] = get_interpolated_flux(t, g, z, filter_names, intp)
+        fluxes = get_interpolated_flux(ogteff, oglogg, ogfeh, filter_names,
+                                       intp)
+        # Median of every filter in a single pass.
+        meds = np.percentile(fluxes, 50, axis=0)
         synthdat = 'Filter\tFlux\n'
-        for i, filt in enumerate(filter_names):
-            samp = fluxes[:, i]
-            # xx, pdf = estimate_pdf(samp)
-            # cdf = estimate_cdf(samp, hdr=True)
-            b, _, _ = credibility_interval(samp, alpha=1)
+        for filt, b in zip(filter_names, meds):
             synthdat += f'{filt}\t{b:.6e}\n'
 
-        for i, param in enumerate(order):
+        for i, param in enumerate(self._order):
             if not self.coordinator[i]:
                 if 'noise' not in param:
                     continue
@@ -1209,7 +1412,7 @@ class Fitter:
         out['star'] = self.star
         out['norm'] = self.norm
         out['engine'] = 'Bayesian Model Averaging'
-        out['av_law'] = av_law
+        out['av_law'] = self._av_law
 
         # Spectral type
 
@@ -1234,7 +1437,8 @@ class Fitter:
             logfile.write(probdat)
         with open(synth_out, 'w') as logfile:
             logfile.write(synthdat)
-        pickle.dump(out, open(out_file, 'wb'))
+        with open(out_file, 'wb') as jar:
+            pickle.dump(out, jar, protocol=pickle.HIGHEST_PROTOCOL)
         pass
 
     @staticmethod
@@ -1289,13 +1493,18 @@ class Fitter:
         out['weighted_average'] = dict()
 
         print(colored('\t\t*** AVERAGING POSTERIOR SAMPLES ***', c))
-        for k in tqdm(post_samples[0].keys()):
+        # Outputs saved before the posterior samples became a structured
+        # array hold them in a dict.
+        if isinstance(post_samples[0], dict):
+            names = list(post_samples[0].keys())
+        else:
+            names = post_samples[0].dtype.names
+        # Skip the params that are fixed in any of the fits.
+        for o in model_posteriors:
+            ban.extend(_saved_order(o)[np.asarray(o['coordinator'], bool)])
+        for k in tqdm(names):
             if k in ban:  # Skip things that are not main parameters.
                 continue
-            try:  # Skip fixed params.
-                len(post_samples[0][k])
-            except TypeError:
-                continue
             traces = []
             extended_weights = []
             out['weighted_samples'][k] = np.zeros(nsamples)
@@ -1380,29 +1589,11 @@ class Fitter:
 
     @staticmethod
     def load_interpolator(model):
-        """Load a DFInterpolator."""
-        if model.lower() == 'phoenix':
-            with open(gridsdir + '/Phoenixv2_DF.pkl', 'rb') as intp:
-                df = DFInterpolator(pd.read_pickle(intp))
-        elif model.lower() == 'btsettl':
-            with open(gridsdir + '/BTSettl_DF.pkl', 'rb') as intp:
-                df = DFInterpolator(pd.read_pickle(intp))
-        elif model.lower() == 'btnextgen':
-            with open(gridsdir + '/BTNextGen_DF.pkl', 'rb') as inp:
-                df = DFInterpolator(pd.read_pickle(inp))
-        elif model.lower() == 'btcond':
-            with open(gridsdir + '/BTCond_DF.pkl', 'rb') as intp:
-                df = DFInterpolator(pd.read_pickle(intp))
-        elif model.lower() == 'ck04':
-            with open(gridsdir + '/CK04_DF.pkl', 'rb') as intp:
-                df = DFInterpolator(pd.read_pickle(intp))
-        elif model.lower() == 'kurucz':
-            with open(gridsdir + '/Kurucz_DF.pkl', 'rb') as intp:
-                df = DFInterpolator(pd.read_pickle(intp))
-        elif model.lower() == 'coelho':
-            with open(gridsdir + '/Coelho_DF.pkl', 'rb') as intp:
-                df = DFInterpolator(pd.read_pickle(intp))
-        return df
+        """Load a DFInterpolator.
+
+        Interpolators are cached, so loading the same model again is free.
+        """
+        return _load_interpolator(model.lower())
 
     def estimate_age(self, bf, unc, c='white'):
         """Estimate age using MIST isochrones.
@@ -1421,7 +1612,7 @@ class Fitter:
             )
         )
         params = dict()  # params for isochrones.
-        for i, k in enumerate(order):
+        for i, k in enumerate(self._order):
             if k == 'logg' or 'noise' in k:
                 continue
             if k == 'teff':
@@ -1462,42 +1653,73 @@ class Fitter:
         return age_samp, mass_samp, eep_samp
 
 
+def _saved_order(output):
+    """Return the parameter order of a per-model output pickle.
+
+    Outputs saved before the order was stored get it rebuilt from the
+    normalization flag and the filters of the star.
+    """
+    if 'order' in output:
+        return output['order']
+    order = _ORDER_NORM if output['norm'] else _ORDER_FULL
+    star = output['star']
+    noise = [get_noise_name(f) + '_noise'
+             for f in star.filter_names[star.filter_mask]]
+    return np.concatenate((order, noise))
+
+
 #####################
 # Dynesty and multinest wrappers
 
 
-def dynesty_loglike_bma(cube, interpolator):
-    """Dynesty log likelihood wrapper for BMA."""
-    theta = build_params(cube, coordinator, fixed, use_norm)
-    return log_likelihood(theta, star, interpolator, use_norm, av_law)
+def _init_worker(key, fields):
+    """Store the sampler state of the pool in a worker."""
+    _POOL_STATES[key] = FitState(*fields)
+
+
+def _drop_worker_state(key):
+    """Remove the sampler state of a closed pool from a worker."""
+    _POOL_STATES.pop(key, None)
+
+
+def _run_on_mpi_workers(pool, func, arg):
+    """Run func(arg) once on every worker rank of an MPIPool.
+
+    Uses the same task protocol as MPIPool.map, but sends one task to each
+    worker instead of letting the free workers take them.
+    """
+    for worker in pool.workers:
+        pool.comm.send((func, arg), dest=worker, tag=0)
+    for worker in pool.workers:
+        pool.comm.recv(source=worker, tag=0)
 
 
-def dynesty_log_like(cube):
+def dynesty_log_like(cube, state):
     """Dynesty log likelihood wrapper."""
+    (flux, flux_er, filts, ext, coordinator, fixed, use_norm, _,
+     band_grid) = state
     theta = build_params(
         cube, flux, flux_er, filts, coordinator, fixed, use_norm
     )
-    return log_likelihood(theta, flux, flux_er, wave,
-                          filts, interpolator, use_norm, av_law)
+    return fast_log_likelihood(theta, flux, flux_er, ext,
+                               filts, band_grid, use_norm)
+
 
+# Each model grid of the BMA has its own state, the wrapper is the same.
+dynesty_loglike_bma = dynesty_log_like
 
-def pt_dynesty(cube):
+
+def pt_dynesty(cube, state):
     """Dynesty prior transform."""
-    return prior_transform_dynesty(cube, flux, flux_er, filts, prior_dict,
-                                   coordinator, use_norm)
+    return prior_transform_dynesty(cube, state.prior_ppfs)
 
 
-def multinest_log_like(cube, ndim, nparams):
+def multinest_log_like(cube, ndim, nparams, state):
     """Multinest log likelihood wrapper."""
     theta = [cube[i] for i in range(ndim)]
-    theta = build_params(
-        theta, flux, flux_er, filts, coordinator, fixed, use_norm
-    )
-    return log_likelihood(theta, flux, flux_er, wave,
-                          filts, interpolator, use_norm, av_law)
+    return dynesty_log_like(theta, state)
 
 
-def pt_multinest(cube, ndim, nparams):
+def pt_multinest(cube, ndim, nparams, state):
     """Multinest prior transform."""
-    prior_transform_multinest(cube, flux, flux_er, filts, prior_dict,
-                              coordinator, use_norm)
+    prior_transform_multinest(cube, state.prior_ppfs)
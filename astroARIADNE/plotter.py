@@ -125,7 +125,8 @@ class SEDPlotter:
 
         # Read output files.
         if input_files != 'raw':
-            out = pickle.load(open(input_files, 'rb'))
+            with open(input_files, 'rb') as jar:
+                out = pickle.load(jar)
             self.out = out
             self.engine = out['engine']
             self.star = out['star']
@@ -1656,10 +1657,12 @@ class SEDPlotter:
     def __read_config(self):
         """Read plotter configuration file."""
         if self.settings_dir is None:
-            settings = open(filesdir + '/plot_settings.dat', 'r')
+            settings_file = filesdir + '/plot_settings.dat'
         else:
-            settings = open(self.settings_dir, 'r')
-        for line in settings.readlines():
+            settings_file = self.settings_dir
+        with open(settings_file, 'r') as settings:
+            lines = settings.readlines()
+        for line in lines:
             if line[0] == '#' or line[0] == '\n':
                 continue
             splt = line.split(' ')
@@ -4,30 +4,161 @@ import numba as nb
 import numpy as np
 from extinction import apply
 
-from .utils import get_noise_name
-
 
 def build_params(theta, flux, flux_e, filts, coordinator, fixed, use_norm):
-    """Build the parameter vector that goes into the model."""
-    params = np.zeros(len(coordinator))
-    if use_norm:
-        order = np.array(['teff', 'logg', 'z', 'norm', 'Av'])
-    else:
-        order = np.array(
-            ['teff', 'logg', 'z', 'dist', 'rad', 'Av']
-        )
-
-    for filt, flx, flx_e in zip(filts, flux, flux_e):
-        p_ = get_noise_name(filt) + '_noise'
-        order = np.append(order, p_)
-    i = 0
-    for j, k in enumerate(order):
-        params[j] = theta[i] if not coordinator[j] else fixed[j]
-        if not coordinator[j]:
-            i += 1
+    """Build the parameter vector that goes into the model.
+
+    Single sample version of `build_params_batch`, used by the sampler
+    wrappers. The flux, flux_e, filts and use_norm arguments are kept for
+    backwards compatibility and aren't used.
+    """
+    params = np.array(fixed, dtype=float)
+    params[coordinator == 0] = theta
+    return params
+
+
+def build_params_batch(thetas, coordinator, fixed):
+    """Build the parameter matrix for a set of samples.
+
+    Parameters
+    ----------
+    thetas : array_like
+        An (N, ndim) array with the free parameters of each sample.
+    coordinator : array_like
+        The status of each parameter (1 for fixed, 0 for free).
+    fixed : array_like
+        The values of the fixed parameters.
+
+    Returns
+    -------
+    params : array_like
+        An (N, npars) array with the full parameter vector of each sample.
+
+    """
+    free = coordinator == 0
+    params = np.empty((thetas.shape[0], len(coordinator)))
+    params[:, free] = thetas
+    params[:, ~free] = fixed[~free]
     return params
 
 
+def _axis_lookup(axis):
+    """Build the cell lookup table of a (possibly non uniform) grid axis.
+
+    The axis range is split in bins as wide as the smallest node spacing, so
+    each bin holds at most one node and the cell of a value is found with
+    one multiplication, a table read and a comparison.
+    """
+    h = np.diff(axis).min()
+    n_bins = int(np.ceil((axis[-1] - axis[0]) / h)) + 1
+    starts = axis[0] + np.arange(n_bins) * h
+    lut = np.searchsorted(axis, starts, side='right') - 1
+    return np.clip(lut, 0, len(axis) - 2), 1. / h
+
+
+@nb.njit(cache=True)
+def _find_cell(x, axis, lut, inv_h):
+    """Return the cell of `axis` that holds `x` and the distance into it."""
+    i = lut[min(int((x - axis[0]) * inv_h), lut.shape[0] - 1)]
+    # Fix round off near the bin edges.
+    while i > 0 and x < axis[i]:
+        i -= 1
+    while i < axis.shape[0] - 2 and x >= axis[i + 1]:
+        i += 1
+    return i, (x - axis[i]) / (axis[i + 1] - axis[i])
+
+
+@nb.njit(cache=True)
+def _trilinear_into(x0, x1, x2, grid, ax0, ax1, ax2, lut0, lut1, lut2,
+                    inv_h0, inv_h1, inv_h2, out):
+    """Trilinear interpolation of every band of the grid at (x0, x1, x2).
+
+    The result is written to `out`, which is NaN outside the grid or if any
+    coordinate is NaN.
+    """
+    if not (ax0[0] <= x0 <= ax0[-1] and ax1[0] <= x1 <= ax1[-1] and
+            ax2[0] <= x2 <= ax2[-1]):
+        out[:] = np.nan
+        return
+    i, f0 = _find_cell(x0, ax0, lut0, inv_h0)
+    j, f1 = _find_cell(x1, ax1, lut1, inv_h1)
+    k, f2 = _find_cell(x2, ax2, lut2, inv_h2)
+    g0, g1 = 1. - f0, 1. - f1
+    g2 = 1. - f2
+    for b in range(out.shape[0]):
+        c00 = grid[i, j, k, b] * g2 + grid[i, j, k + 1, b] * f2
+        c01 = grid[i, j + 1, k, b] * g2 + grid[i, j + 1, k + 1, b] * f2
+        c10 = grid[i + 1, j, k, b] * g2 + grid[i + 1, j, k + 1, b] * f2
+        c11 = grid[i + 1, j + 1, k, b] * g2 + grid[i + 1, j + 1, k + 1, b] * f2
+        out[b] = ((c00 * g1 + c01 * f1) * g0 +
+                  (c10 * g1 + c11 * f1) * f0)
+
+
+@nb.njit(cache=True)
+def _trilinear(x0, x1, x2, grid, ax0, ax1, ax2, lut0, lut1, lut2, inv_h0,
+               inv_h1, inv_h2):
+    """Interpolate every band of the grid at (x0, x1, x2)."""
+    out = np.empty(grid.shape[3])
+    _trilinear_into(x0, x1, x2, grid, ax0, ax1, ax2, lut0, lut1, lut2,
+                    inv_h0, inv_h1, inv_h2, out)
+    return out
+
+
+@nb.njit(cache=True)
+def _trilinear_many(x0, x1, x2, grid, ax0, ax1, ax2, lut0, lut1, lut2,
+                    inv_h0, inv_h1, inv_h2):
+    """Vectorized version of `_trilinear`, returns an (N, bands) array."""
+    out = np.empty((x0.shape[0], grid.shape[3]))
+    for n in range(x0.shape[0]):
+        _trilinear_into(x0[n], x1[n], x2[n], grid, ax0, ax1, ax2, lut0, lut1,
+                        lut2, inv_h0, inv_h1, inv_h2, out[n])
+    return out
+
+
+class BandGrid:
+    """Model grid restricted to the filters of a star.
+
+    The fluxes of the selected filters are copied from a DFInterpolator into a
+    single contiguous (logg, teff, z, band) tensor, so every interpolation
+    reads all the bands of a grid node from one block of memory and there's no
+    per call lookup of the filter columns. The cell lookup tables of the
+    axes are also built here, the teff and z axes of most grids aren't evenly
+    spaced. It can be used anywhere a DFInterpolator is expected for those
+    filters.
+
+    Parameters
+    ----------
+    interpolator : DFInterpolator
+        The interpolator of the model grid.
+    filts : array_like
+        The filters to keep.
+
+    """
+
+    def __init__(self, interpolator, filts):
+        icols = [interpolator.column_index[f] for f in filts]
+        self.filts = np.array(filts)
+        self.grid = np.ascontiguousarray(interpolator.grid[..., icols])
+        self.axes = tuple(np.asarray(ax, dtype=float)
+                          for ax in interpolator.index_columns)
+        luts, inv_hs = zip(*[_axis_lookup(ax) for ax in self.axes])
+        self._args = (self.grid, *self.axes, *luts, *inv_hs)
+
+    def __call__(self, values, filts=None):
+        """Interpolate the fluxes at (logg, teff, z).
+
+        `filts` is only there for compatibility with DFInterpolator, if given
+        it must be the filters given at construction.
+        """
+        assert filts is None or np.array_equal(filts, self.filts)
+        logg, teff, z = values
+        if np.ndim(logg) == 0 and np.ndim(teff) == 0 and np.ndim(z) == 0:
+            return _trilinear(float(logg), float(teff), float(z), *self._args)
+        pp = [np.ascontiguousarray(x, dtype=float).ravel()
+              for x in np.broadcast_arrays(logg, teff, z)]
+        return _trilinear_many(*pp, *self._args)
+
+
 def get_interpolated_flux(temp, logg, z, filts, interpolators):
     """Interpolate the grid of fluxes in a given teff, logg and z.
 
@@ -105,13 +236,86 @@ def get_residuals(theta, flux, flux_er, wave, filts, interpolators, use_norm,
     return residuals, errs
 
 
+def unit_extinction(wave, av_law):
+    """Calculate the extinction curve for Av = 1.
+
+    All the available extinction laws are linear in Av, so the extinction for
+    any Av is this curve scaled by Av.
+    """
+    Rv = 3.1  # For extinction.
+    return av_law(wave * 1e4, 1., Rv)
+
+
 def log_likelihood(theta, flux, flux_er, wave, filts, interpolators, use_norm,
                    av_law):
     """Calculate log likelihood of the model."""
-    res, ers = get_residuals(theta, flux, flux_er, wave,
-                             filts, interpolators, use_norm, av_law)
+    ext = unit_extinction(wave, av_law)
+    return fast_log_likelihood(theta, flux, flux_er, ext, filts,
+                               interpolators, use_norm)
+
+
+def fast_log_likelihood(theta, flux, flux_er, ext, filts, interpolators,
+                        use_norm):
+    """Calculate log likelihood of the model with a precomputed extinction.
 
-    lnl = fast_loglik(res, ers)
+    `ext` is the extinction curve for Av = 1 as given by `unit_extinction`.
+    With a BandGrid the interpolation and the likelihood run in a single
+    compiled call.
+    """
+    theta = np.asarray(theta, dtype=float)
+    if isinstance(interpolators, BandGrid):
+        return _band_log_like_njit(theta, flux, flux_er, ext, use_norm,
+                                   *interpolators._args)
+    flx = get_interpolated_flux(theta[0], theta[1], theta[2], filts,
+                                interpolators)
+    return _log_like_njit(theta, flx, flux, flux_er, ext, use_norm)
+
+
+def log_likelihood_batch(thetas, flux, flux_er, wave, filts, interpolators,
+                         use_norm, av_law):
+    """Calculate log likelihood of the model for a set of samples.
+
+    Vectorized version of `log_likelihood` that takes an (N, npars) array of
+    parameter vectors and returns an (N,) array of log likelihoods.
+    """
+    start = 5 if use_norm else 6
+
+    teff, logg, z = thetas[:, 0], thetas[:, 1], thetas[:, 2]
+    Av = thetas[:, start - 1]
+    if use_norm:
+        scale = thetas[:, 3]
+    else:
+        dist = thetas[:, 3] * 4.435e+7  # Transform from pc to solRad
+        scale = (thetas[:, 4] / dist) ** 2
+
+    flx = get_interpolated_flux(teff, logg, z, filts, interpolators)
+
+    ext = unit_extinction(wave, av_law)
+    model = flx * 10 ** (-.4 * Av[:, None] * ext) * scale[:, None]
+
+    residuals = flux - model
+    ers2 = flux_er ** 2 + thetas[:, start:] ** 2
+    lnl = (np.log(2 * np.pi * ers2) + residuals ** 2 / ers2).sum(axis=1)
+    lnl = -.5 * lnl
+    lnl[~np.isfinite(lnl)] = -1e300
+    return lnl
+
+
+@nb.njit(cache=True)
+def _log_like_njit(theta, flx, flux, flux_er, ext, use_norm):
+    """Apply extinction and dilution to the fluxes and get the log likelihood."""
+    if use_norm:
+        start = 5
+        scale = theta[3]
+    else:
+        start = 6
+        scale = (theta[4] / (theta[3] * 4.435e+7)) ** 2
+    Av = theta[start - 1]
+    lnl = 0.
+    for i in range(flux.shape[0]):
+        model = flx[i] * 10 ** (-.4 * Av * ext[i]) * scale
+        ers2 = flux_er[i] ** 2 + theta[start + i] ** 2
+        lnl += np.log(2 * np.pi * ers2) + (flux[i] - model) ** 2 / ers2
 
     if not np.isfinite(lnl):
         return -1e300
@@ -119,84 +323,88 @@ def log_likelihood(theta, flux, flux_er, wave, filts, interpolators, use_norm,
     return -.5 * lnl
 
 
-@nb.njit
-def fast_loglik(res, ers):
-    ers2 = ers ** 2
-    c = np.log(2 * np.pi * ers2)
-    lnl = (c + (res ** 2 / ers2)).sum()
-    return lnl
+@nb.njit(cache=True)
+def _band_log_like_njit(theta, flux, flux_er, ext, use_norm, grid, ax0, ax1,
+                        ax2, lut0, lut1, lut2, inv_h0, inv_h1, inv_h2):
+    """Interpolate a BandGrid at theta and get the log likelihood."""
+    flx = _trilinear(theta[1], theta[0], theta[2], grid, ax0, ax1, ax2, lut0,
+                     lut1, lut2, inv_h0, inv_h1, inv_h2)
+    return _log_like_njit(theta, flx, flux, flux_er, ext, use_norm)
 
 
-def prior_transform_dynesty(u, flux, flux_er, filts, prior_dict, coordinator,
-                            use_norm):
-    """Transform the prior from the unit cube to the parameter space."""
+class TabulatedPPF:
+    """Percent point function tabulated on a grid of quantiles.
+
+    Lightweight replacement for the pickled scipy splines, the ppf is
+    linearly interpolated from the table.
+
+    Parameters
+    ----------
+    u : array_like
+        The quantiles, in increasing order.
+    x : array_like
+        The values of the ppf at `u`.
+
+    """
+
+    def __init__(self, u, x):
+        self.u = u
+        self.x = x
+
+    def ppf(self, q):
+        """Evaluate the ppf at the quantile(s) `q`."""
+        return np.interp(q, self.u, self.x)
+
+    __call__ = ppf
+
+
+def tabulate_ppf(dist, n=1024):
+    """Tabulate the ppf of a frozen scipy distribution.
+
+    The quantile grid is linear in the bulk and logarithmic towards both
+    tails, so the tails of normal priors keep their accuracy. Quantiles
+    beyond the last tabulated one are clipped to the table edges.
+
+    Parameters
+    ----------
+    dist : scipy.stats frozen distribution
+        The prior distribution.
+    n : int, optional
+        The approximate number of points in the table.
+
+    Returns
+    -------
+    ppf : TabulatedPPF
+        The tabulated ppf.
+
+    """
+    if isinstance(dist, TabulatedPPF):
+        return dist
+    n_tail = n // 8
+    tail = np.geomspace(1e-12, 1e-2, n_tail, endpoint=False)
+    u = np.concatenate(
+        ([0.], tail, np.linspace(1e-2, 1 - 1e-2, n - 2 * n_tail - 2),
+         1 - tail[::-1], [1.])
+    )
+    x = dist.ppf(u)
+    # Unbounded priors have infinite ppf at 0 and 1, drop those ends.
+    finite = np.isfinite(x)
+    return TabulatedPPF(u[finite], x[finite])
+
+
+def prior_transform_dynesty(u, ppfs):
+    """Transform the prior from the unit cube to the parameter space.
+
+    `ppfs` holds the (tabulated) ppf of each free parameter, in order.
+    """
     u2 = np.array(u)
-    if use_norm:
-        order = np.array(['teff', 'logg', 'z', 'norm', 'Av'])
-    else:
-        order = np.array(
-            ['teff', 'logg', 'z', 'dist', 'rad', 'Av']
-        )
-
-    for filt, flx, flx_e in zip(filts, flux, flux_er):
-        p_ = get_noise_name(filt) + '_noise'
-        order = np.append(order, p_)
-
-    i = 0
-    for fixed, par in zip(coordinator, order):
-        if fixed:
-            continue
-        if par == 'logg':
-            try:
-                u2[i] = prior_dict['logg'](u2[i])
-            except TypeError:
-                u2[i] = prior_dict['logg'].ppf(u2[i])
-            i += 1
-            continue
-        if par == 'teff':
-            try:
-                u2[i] = prior_dict['teff'](u2[i])
-            except TypeError:
-                u2[i] = prior_dict['teff'].ppf(u2[i])
-            i += 1
-            continue
-        u2[i] = prior_dict[par].ppf(u2[i])
-        i += 1
+    for i, ppf in enumerate(ppfs):
+        u2[i] = ppf(u2[i])
     return u2
 
 
-def prior_transform_multinest(u, flux, flux_er, filts, prior_dict, coordinator,
-                              use_norm):
+def prior_transform_multinest(u, ppfs):
     """Transform the prior from the unit cube to the parameter space."""
-    if use_norm:
-        order = np.array(['teff', 'logg', 'z', 'norm', 'Av'])
-    else:
-        order = np.array(
-            ['teff', 'logg', 'z', 'dist', 'rad', 'Av']
-        )
-
-    for filt, flx, flx_e in zip(filts, flux, flux_er):
-        p_ = get_noise_name(filt) + '_noise'
-        order = np.append(order, p_)
-
-    i = 0
-    for fixed, par in zip(coordinator, order):
-        if fixed:
-            continue
-        if par == 'logg':
-            try:
-                u[i] = prior_dict['logg'](u[i])
-            except TypeError:
-                u[i] = prior_dict['logg'].ppf(u[i])
-            i += 1
-            continue
-        if par == 'teff':
-            try:
-                u[i] = prior_dict['teff'](u[i])
-            except TypeError:
-                u[i] = prior_dict['teff'].ppf(u[i])
-            i += 1
-            continue
-        u[i] = prior_dict[par].ppf(u[i])
-        i += 1
+    for i, ppf in enumerate(ppfs):
+        u[i] = ppf(u[i])
     pass
@@ -12,7 +12,6 @@ import os
 import pickle
 import random
 import time
-from contextlib import closing
 
 import numpy as np
 from scipy.special import erf
@@ -246,7 +245,7 @@ def end(coordinator, elapsed_time, out_folder, engine, use_norm):
         res_dir = f'{out_folder}/BMA.pkl'
     else:
         res_dir = f'{out_folder}/{engine}_out.pkl'
-    with closing(open(res_dir, 'rb')) as jar:
+    with open(res_dir, 'rb') as jar:
         out = pickle.load(jar)
 
     star = out['star']